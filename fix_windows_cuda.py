@@ -3,9 +3,121 @@ Script to automatically fix FlexGEMM, CuMesh, and o-voxel files for Windows comp
 This script replaces undefined 'uint' types with 'uint32_t' in the neighbor_map.cu file, adds necessary compilation flags to CuMesh setup.py, and fixes MSVC compatibility issues in o-voxel source files.
 """
 
+import concurrent.futures
+import mmap
 import os
 import platform
 import re
+import shutil
+import tempfile
+
+# Appended (as a comment) to every file this script rewrites, so later runs can
+# tell a patched file apart by reading only its last few bytes.
+_MARKER = b'__trellis_win_patched_v1__'
+
+def _has_marker(f):
+    """Check whether an open binary file ends with the patch marker."""
+    size = os.fstat(f.fileno()).st_size
+    f.seek(max(0, size - 64))
+    found = _MARKER in f.read()
+    f.seek(0)
+    return found
+
+def _mark(file_path, content):
+    """Append the patch marker to content as a comment suited to the file type."""
+    comment = b'#' if file_path.endswith('.py') else b'//'
+    if not content.endswith(b'\n'):
+        content += b'\n'
+    return content + comment + b' ' + _MARKER + b'\n'
+
+def _write_file(file_path, content):
+    """Atomically replace the contents of a file with the given bytes."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _patch_file(file_path, pattern, repl):
+    """Apply a precompiled byte pattern to a file in a single scan.
+
+    Returns True if the file was rewritten. Files already carrying the patch
+    marker are skipped without being scanned.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0 or _has_marker(f):
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content, n = pattern.subn(repl, mm)
+
+    if n > 0:
+        _write_file(file_path, _mark(file_path, content))
+    return n > 0
+
+# FlexGEMM neighbor_map.cu: fixed literals, matched in one pass and looked up by text
+_FLEXGEMM_MAP = {
+    b'uint tmp = neigh_map[n * V + v];': b'uint32_t tmp = neigh_map[n * V + v];',
+    b'*(uint*)&neigh_map_T[v * N + n + n_base] = tmp;': b'*(uint32_t*)&neigh_map_T[v * N + n + n_base] = tmp;',
+    b'*(uint*)&neigh_mask_T[v * N + n + n_base] = tmp;': b'*(uint32_t*)&neigh_mask_T[v * N + n + n_base] = tmp;',
+}
+_FLEXGEMM_RE = re.compile(b'|'.join(re.escape(old) for old in _FLEXGEMM_MAP))
+
+def _flexgemm_repl(match):
+    """Look up the replacement for the matched FlexGEMM literal."""
+    return _FLEXGEMM_MAP[match.group(0)]
+
+# cumesh._C nvcc: add -Xcudafe --diag_suppress=2872
+_CUMESH_NVCC_RE = re.compile(re.escape(b'"nvcc": ["-O3","-std=c++17"] + cc_flag,'))
+_CUMESH_NVCC_REPL = b'"nvcc": ["-O3","-std=c++17"] + cc_flag + [\n                    "-Xcudafe", "--diag_suppress=2872",\n                ],'
+
+# cumesh._cubvh cxx: add -Dssize_t=ptrdiff_t
+_CUBVH_CXX_RE = re.compile(re.escape(b'"cxx": ["-O3", "-std=c++17"],'))
+_CUBVH_CXX_REPL = b'"cxx": ["-O3", "-std=c++17", "-Dssize_t=ptrdiff_t"],'
+
+# cumesh._cubvh nvcc: the last half-precision flag before the closing bracket
+# (files are read in binary mode, so allow CRLF endings)
+_CUBVH_NVCC_RE = re.compile(
+    rb'(?P<indent>[ \t]*)"-U__CUDA_NO_HALF2_OPERATORS__",(?P<eol>\r?\n)(?=[ \t]*\])'
+)
+_CUBVH_NVCC_REPL = rb'\g<0>\g<indent>"-Xcudafe", "--diag_suppress=2872",\g<eol>'
+
+# o-voxel src/io/svo.cpp: from_blob shapes built from size_t
+_SVO_RE = re.compile(
+    rb'(?P<codes>torch::from_blob\(codes\.data\(\), \{codes\.size\(\)\}, torch::kInt32\))'
+    rb'|(?P<svo>torch::from_blob\(svo\.data\(\), \{svo\.size\(\)\}, torch::kUInt8\))'
+)
+
+def _svo_repl(match):
+    """Cast the matched from_blob shape to int64_t."""
+    if match.lastgroup == 'codes':
+        return b'torch::from_blob(codes.data(), {static_cast<int64_t>(codes.size())}, torch::kInt32)'
+    return b'torch::from_blob(svo.data(), {static_cast<int64_t>(svo.size())}, torch::kUInt8)'
+
+# o-voxel src/io/filter_neighbor.cpp and filter_parent.cpp: zeros shapes built from size_t
+_NEIGHBOR_RE = re.compile(
+    rb'(\s*)torch::Tensor\s+(\w+)\s*=\s*torch::zeros\(\{(\w+),\s*(\w+)\},\s*torch::dtype\(torch::kUInt8\)\);'
+)
+_NEIGHBOR_REPL = rb'\1torch::Tensor \2 = torch::zeros({static_cast<int64_t>(\3), static_cast<int64_t>(\4)}, torch::dtype(torch::kUInt8));'
+
+# o-voxel src/convert/flexible_dual_grid.cpp: 'd' suffixed double literals
+_GRID_RE = re.compile(rb'1e-6d|0\.0d')
+
+def _grid_repl(match):
+    """Drop the non-standard 'd' suffix from the matched literal."""
+    return match.group(0)[:-1]
+
+# o-voxel files to patch, relative to the o-voxel checkout
+_O_VOXEL_TASKS = (
+    ('src/io/svo.cpp', _SVO_RE, _svo_repl),
+    ('src/io/filter_neighbor.cpp', _NEIGHBOR_RE, _NEIGHBOR_REPL),
+    ('src/io/filter_parent.cpp', _NEIGHBOR_RE, _NEIGHBOR_REPL),
+    ('src/convert/flexible_dual_grid.cpp', _GRID_RE, _grid_repl),
+)
 
 def fix_flexgemm_cuda_file():
     """Fix the FlexGEMM CUDA file by replacing 'uint' with 'uint32_t'."""
@@ -16,22 +128,11 @@ def fix_flexgemm_cuda_file():
             print(f"File not found: {file_path}")
             return
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Check if fixes are needed
-        original_content = content
-        content = content.replace('uint tmp = neigh_map[n * V + v];', 'uint32_t tmp = neigh_map[n * V + v];')
-        content = content.replace('*(uint*)&neigh_map_T[v * N + n + n_base] = tmp;', '*(uint32_t*)&neigh_map_T[v * N + n + n_base] = tmp;')
-        content = content.replace('*(uint*)&neigh_mask_T[v * N + n + n_base] = tmp;', '*(uint32_t*)&neigh_mask_T[v * N + n + n_base] = tmp;')
-        
-        if content != original_content:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+        if _patch_file(file_path, _FLEXGEMM_RE, _flexgemm_repl):
             print("Fixed FlexGEMM CUDA file for Windows compatibility.")
         else:
             print("FlexGEMM CUDA file already fixed or no changes needed.")
-    except (OSError, UnicodeDecodeError) as e:
+    except (OSError, ValueError) as e:
         print(f"Error processing {file_path}: {e}")
         return
 
@@ -44,123 +145,83 @@ def fix_cumesh_setup():
         return
     
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-    except (OSError, UnicodeDecodeError) as e:
+        with open(file_path, 'rb') as f:
+            if _has_marker(f):
+                print("CuMesh setup.py already fixed or no changes needed.")
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                content = mm[:]
+    except (OSError, ValueError) as e:
         print(f"Error reading {file_path}: {e}")
         return
     
-    original_content = content
+    changed = False
     
-    # For cumesh._C nvcc: add -Xcudafe --diag_suppress=2872
-    nvcc_section = content.split('"nvcc": [')[1].split('],')[0]
-    if '"-Xcudafe"' not in nvcc_section or '"--diag_suppress=2872"' not in nvcc_section:
-        old = '"nvcc": ["-O3","-std=c++17"] + cc_flag,'
-        new = '"nvcc": ["-O3","-std=c++17"] + cc_flag + [\n                    "-Xcudafe", "--diag_suppress=2872",\n                ],'
-        content = content.replace(old, new)
+    # For cumesh._C nvcc: add -Xcudafe --diag_suppress=2872 (once added, the
+    # pattern no longer matches, so no separate probe is needed)
+    content, n = _CUMESH_NVCC_RE.subn(_CUMESH_NVCC_REPL, content)
+    changed |= n > 0
     
     # For cumesh._cubvh cxx: add -Dssize_t=ptrdiff_t
-    cubvh_start = content.find("name='cumesh._cubvh'")
-    xatlas_start = content.find("name='cumesh._xatlas'")
+    cubvh_start = content.find(b"name='cumesh._cubvh'")
+    xatlas_start = content.find(b"name='cumesh._xatlas'")
     if cubvh_start != -1 and xatlas_start != -1:
         cubvh_section = content[cubvh_start:xatlas_start]
-        if '"-Dssize_t=ptrdiff_t"' not in cubvh_section:
-            old = '"cxx": ["-O3", "-std=c++17"],'
-            new = '"cxx": ["-O3", "-std=c++17", "-Dssize_t=ptrdiff_t"],'
+        if b'"-Dssize_t=ptrdiff_t"' not in cubvh_section:
             # Replace only in cubvh_section
-            cubvh_section_new = cubvh_section.replace(old, new, 1)
-            content = content.replace(cubvh_section, cubvh_section_new)
+            cubvh_section_new, n = _CUBVH_CXX_RE.subn(_CUBVH_CXX_REPL, cubvh_section, count=1)
+            if n > 0:
+                content = content[:cubvh_start] + cubvh_section_new + content[xatlas_start:]
+                changed = True
     
     # For cumesh._cubvh nvcc: add -Xcudafe --diag_suppress=2872
-    cubvh_nvcc_old = '''"nvcc": ["-O3","-std=c++17"] + cc_flag + [
-                        "--extended-lambda",
-                        "--expt-relaxed-constexpr",
-                        # The following definitions must be undefined
-                        # since we need half-precision operation.
-                        "-U__CUDA_NO_HALF_OPERATORS__",
-                        "-U__CUDA_NO_HALF_CONVERSIONS__",
-                        "-U__CUDA_NO_HALF2_OPERATORS__",
-                    ]'''
-    cubvh_nvcc_new = '''"nvcc": ["-O3","-std=c++17"] + cc_flag + [
-                        "--extended-lambda",
-                        "--expt-relaxed-constexpr",
-                        # The following definitions must be undefined
-                        # since we need half-precision operation.
-                        "-U__CUDA_NO_HALF_OPERATORS__",
-                        "-U__CUDA_NO_HALF_CONVERSIONS__",
-                        "-U__CUDA_NO_HALF2_OPERATORS__",
-                        "-Xcudafe", "--diag_suppress=2872",
-                    ]'''
-    if cubvh_nvcc_old in content:
-        content = content.replace(cubvh_nvcc_old, cubvh_nvcc_new)
+    content, n = _CUBVH_NVCC_RE.subn(_CUBVH_NVCC_REPL, content)
+    changed |= n > 0
     
-    if content != original_content:
+    if changed:
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            _write_file(file_path, _mark(file_path, content))
             print("Fixed CuMesh setup.py for Windows compatibility.")
-        except (OSError, UnicodeEncodeError) as e:
+        except OSError as e:
             print(f"Error writing {file_path}: {e}")
             return
     else:
         print("CuMesh setup.py already fixed or no changes needed.")
 
-def _apply_file_fixes(file_path, replacements, description):
-    """Helper function to apply replacements to a file."""
+def _apply_file_fixes(file_path, pattern, repl, description):
+    """Helper function to apply a precompiled pattern to a file, returning a status message."""
     try:
-        if not os.path.exists(file_path):
-            return
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        original_content = content
-        for pattern, replacement in replacements:
-            content = re.sub(pattern, replacement, content)
-        
-        if content != original_content:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            print(f"Fixed {description} for MSVC compatibility.")
-        else:
-            print(f"{description} already fixed or no changes needed.")
-    except (OSError, UnicodeError) as e:
-        print(f"Error processing {file_path}: {e}")
-        return
+        if _patch_file(file_path, pattern, repl):
+            return f"Fixed {description} for MSVC compatibility."
+        return f"{description} already fixed or no changes needed."
+    except (OSError, ValueError) as e:
+        return f"Error processing {file_path}: {e}"
+
+def _existing_files(base_path, rel_paths):
+    """Return the subset of rel_paths present under base_path, listing each directory once."""
+    existing = set()
+    for rel_dir in {os.path.dirname(rel_path) for rel_path in rel_paths}:
+        try:
+            with os.scandir(os.path.join(base_path, rel_dir)) as entries:
+                existing.update(f"{rel_dir}/{entry.name}" for entry in entries if entry.is_file())
+        except OSError:
+            continue
+    return existing.intersection(rel_paths)
 
 def fix_o_voxel_files():
     """Fix the o-voxel source files for MSVC compatibility."""
     base_path = 'tmp/extensions/o-voxel'
     
-    # Fix src/io/svo.cpp
-    svo_fixes = [
-        ('torch::Tensor codes_tensor = torch::from_blob(codes.data(), {codes.size()}, torch::kInt32).clone();',
-         'torch::Tensor codes_tensor = torch::from_blob(codes.data(), {static_cast<int64_t>(codes.size())}, torch::kInt32).clone();'),
-        ('torch::Tensor svo_tensor = torch::from_blob(svo.data(), {svo.size()}, torch::kUInt8).clone();',
-         'torch::Tensor svo_tensor = torch::from_blob(svo.data(), {static_cast<int64_t>(svo.size())}, torch::kUInt8).clone();'),
-    ]
-    _apply_file_fixes(os.path.join(base_path, 'src/io/svo.cpp'), svo_fixes, 'o-voxel src/io/svo.cpp')
-    
-    # Fix src/io/filter_neighbor.cpp
-    neighbor_fixes = [
-        (r'(\s*)torch::Tensor\s+(\w+)\s*=\s*torch::zeros\(\{(\w+),\s*(\w+)\},\s*torch::dtype\(torch::kUInt8\)\);',
-         r'\1torch::Tensor \2 = torch::zeros({static_cast<int64_t>(\3), static_cast<int64_t>(\4)}, torch::dtype(torch::kUInt8));'),
-    ]
-    _apply_file_fixes(os.path.join(base_path, 'src/io/filter_neighbor.cpp'), neighbor_fixes, 'o-voxel src/io/filter_neighbor.cpp')
-    
-    # Fix src/io/filter_parent.cpp
-    parent_fixes = [
-        (r'(\s*)torch::Tensor\s+(\w+)\s*=\s*torch::zeros\(\{(\w+),\s*(\w+)\},\s*torch::dtype\(torch::kUInt8\)\);',
-         r'\1torch::Tensor \2 = torch::zeros({static_cast<int64_t>(\3), static_cast<int64_t>(\4)}, torch::dtype(torch::kUInt8));'),
-    ]
-    _apply_file_fixes(os.path.join(base_path, 'src/io/filter_parent.cpp'), parent_fixes, 'o-voxel src/io/filter_parent.cpp')
-    
-    # Fix src/convert/flexible_dual_grid.cpp
-    grid_fixes = [
-        ('1e-6d', '1e-6'),
-        ('0.0d', '0.0'),
-    ]
-    _apply_file_fixes(os.path.join(base_path, 'src/convert/flexible_dual_grid.cpp'), grid_fixes, 'o-voxel src/convert/flexible_dual_grid.cpp')
+    # The files are independent and small, so overlap their I/O
+    existing = _existing_files(base_path, [task[0] for task in _O_VOXEL_TASKS])
+    tasks = [task for task in _O_VOXEL_TASKS if task[0] in existing]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        messages = executor.map(
+            lambda task: _apply_file_fixes(os.path.join(base_path, task[0]), task[1], task[2], f'o-voxel {task[0]}'),
+            tasks,
+        )
+        for message in messages:
+            print(message)
 
 def fix_nvdiffrec_manifest():
     """Create MANIFEST.in for nvdiffrec to include header files."""
@@ -172,27 +233,28 @@ def fix_nvdiffrec_manifest():
         print(f"Warning: Target directory {target_dir} does not exist. Skipping MANIFEST.in creation.")
         return
     
-    expected_content = 'recursive-include nvdiffrec_render/renderutils/c_src *.h\n'
+    expected_content = b'recursive-include nvdiffrec_render/renderutils/c_src *.h\n'
     
-    # Check if file exists and has correct content
-    if os.path.exists(manifest_file):
+    # Check if file exists and has correct content; a size mismatch means it
+    # needs rewriting without reading it at all
+    if os.path.exists(manifest_file) and os.path.getsize(manifest_file) == len(expected_content):
         try:
-            with open(manifest_file, 'r', encoding='utf-8') as f:
+            with open(manifest_file, 'rb') as f:
                 current_content = f.read()
             if current_content == expected_content:
                 print("nvdiffrec MANIFEST.in already has correct content.")
                 return
-        except (OSError, UnicodeDecodeError) as e:
+        except OSError as e:
             print(f"Error reading existing {manifest_file}: {e}")
             # Continue to overwrite
     
     # Create directory if needed and write file
     try:
         os.makedirs(manifest_dir, exist_ok=True)
-        with open(manifest_file, 'w', encoding='utf-8') as f:
+        with open(manifest_file, 'wb') as f:
             f.write(expected_content)
         print("Created/updated nvdiffrec MANIFEST.in for Windows compatibility.")
-    except (OSError, UnicodeEncodeError) as e:
+    except OSError as e:
         print(f"Error creating/updating {manifest_file}: {e}")
 
 if __name__ == '__main__':